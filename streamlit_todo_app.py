@@ -1,236 +1,719 @@
 import streamlit as st
 from datetime import datetime, timezone
+import atexit
+import bisect
+import html
+import itertools
 import json
+import logging
 import os
+import queue
+import re
+import threading
+import time
+import uuid
+from collections import deque
+from contextlib import contextmanager
 from pathlib import Path
+import msgpack
 import requests
 from dotenv import load_dotenv
+from tenacity import retry, retry_if_exception, stop_after_attempt, wait_exponential
+
+try:
+    import orjson
+except ImportError:  # optional speedup, stdlib json works too
+    orjson = None
+
+try:
+    import ijson
+except ImportError:  # only used to stream large legacy tasks.json files
+    ijson = None
+
+try:
+    import fcntl
+except ImportError:  # not available on Windows
+    fcntl = None
 
 # Load .env variables
 load_dotenv()
 
 # ---------- Session state setup ----------
-if "tasks" not in st.session_state:
-    st.session_state.tasks = []
-if "refresh" not in st.session_state:
-    st.session_state.refresh = False
-if "ai_suggested_title" not in st.session_state:
-    st.session_state.ai_suggested_title = ""
+if "dirty_ids" not in st.session_state:
+    # Ids changed this run, in change order (a dict used as an ordered set)
+    st.session_state.dirty_ids = {}
+if "ai_suggested" not in st.session_state:
+    # Widget key -> AI suggestion, applied before the widgets are next created
+    st.session_state.ai_suggested = {}
 
 # ---------- Perplexity API setup ----------
 PERPLEXITY_API_KEY = os.environ.get("PERPLEXITY_API_KEY")
 USE_PERPLEXITY = PERPLEXITY_API_KEY is not None
+PERPLEXITY_TOKENS_PER_MINUTE = int(os.environ.get("PERPLEXITY_TOKENS_PER_MINUTE", "20000"))
+
+logger = logging.getLogger(__name__)
 
 # ---------- Persistence helpers ----------
-DATA_FILE = Path("tasks.json")
+# Tasks are stored as an append-only log of MessagePack {"op", "task"} records:
+# "upsert" stores a whole task, "del" and "top" only need {"id": ...}.
+# JSON is kept for exports and for importing the older file formats.
+DATA_FILE = Path("tasks.msgpack")
+JSONL_DATA_FILE = Path("tasks.jsonl")
+LEGACY_DATA_FILE = Path("tasks.json")
+LOCK_FILE = Path("tasks.msgpack.lock")
+COMPACT_RATIO = 2
+STREAM_PARSE_MIN_BYTES = 256 * 1024
 
-def load_tasks():
+def _json_loads(data: bytes):
+    if orjson is not None:
+        return orjson.loads(data)
+    return json.loads(data.decode("utf-8"))
+
+def _json_dumps(obj) -> bytes:
+    if orjson is not None:
+        return orjson.dumps(obj, option=orjson.OPT_INDENT_2 | orjson.OPT_NON_STR_KEYS)
+    return json.dumps(obj, ensure_ascii=False, indent=2).encode("utf-8")
+
+def _record(op: str, task: dict) -> bytes:
+    return msgpack.packb({"op": op, "task": task}, use_bin_type=True)
+
+def _msgpack_records(unpacker):
+    # Records don't self-resynchronize, so stop at the first one that doesn't
+    # decode to a dict; _repair_log cuts the file back to that point
+    while True:
+        try:
+            rec = next(unpacker)
+        except StopIteration:
+            return
+        except Exception:
+            return  # garbled bytes from an interrupted append
+        if not isinstance(rec, dict):
+            return
+        yield rec
+
+def _jsonl_records(f):
+    for line in f:
+        if not line.strip():
+            continue
+        try:
+            yield _json_loads(line)
+        except ValueError:
+            continue  # torn last line from an interrupted append
+
+def _replay(records) -> list:
+    tasks = {}
+    for rec in records:
+        if not isinstance(rec, dict):
+            continue
+        task = rec.get("task")
+        if not isinstance(task, dict):
+            continue
+        tid = task.get("id")
+        op = rec.get("op")
+        if op == "upsert":
+            tasks[tid] = task
+        elif op == "del":
+            tasks.pop(tid, None)
+        elif op == "top" and tid in tasks:
+            tasks = {tid: tasks.pop(tid), **tasks}
+    return list(tasks.values())
+
+def _read_log() -> list:
+    with open(DATA_FILE, "rb") as f:
+        return _replay(_msgpack_records(msgpack.Unpacker(f, raw=False)))
+
+def _repair_log():
+    """Truncate the log after its last complete record.
+
+    Anything appended behind a torn record would be unreadable, so this must
+    run before the first append of a server's lifetime.
+    """
+    if not DATA_FILE.exists():
+        return
+    with open(DATA_FILE, "r+b") as f:
+        unpacker = msgpack.Unpacker(f, raw=False)
+        end = 0
+        for _ in _msgpack_records(unpacker):
+            end = unpacker.tell()
+        if end < os.fstat(f.fileno()).st_size:
+            logger.warning("Dropping %d unreadable bytes at the end of %s", os.fstat(f.fileno()).st_size - end, DATA_FILE)
+            f.truncate(end)
+
+@contextmanager
+def _locked(lock):
+    # `lock` guards this server (it is _writer()["lock"]), flock guards
+    # against other processes on the file
+    with lock, open(LOCK_FILE, "a") as lock_file:
+        if fcntl is not None:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+        yield
+
+def _write_snapshot(tasks) -> int:
+    # Write to a temp file and swap it in so readers never see a partial file
+    data = b"".join(_record("upsert", t) for t in tasks)
+    tmp = DATA_FILE.with_name(DATA_FILE.name + ".tmp")
+    tmp.write_bytes(data)
+    os.replace(tmp, DATA_FILE)
+    return len(data)
+
+@st.cache_data(show_spinner=False)
+def _load_tasks(mtime: float):
+    # mtime is only the cache key: a changed file means a fresh parse
     if DATA_FILE.exists():
         try:
-            with open(DATA_FILE, "r", encoding="utf-8") as f:
-                return json.load(f)
+            return _read_log()
         except Exception:
             return []
     return []
 
-def save_tasks(tasks):
-    with open(DATA_FILE, "w", encoding="utf-8") as f:
-        json.dump(tasks, f, ensure_ascii=False, indent=2)
+def _load_legacy_tasks():
+    if ijson is not None and LEGACY_DATA_FILE.stat().st_size > STREAM_PARSE_MIN_BYTES:
+        # Stream big files item by item rather than holding the whole
+        # document and its parse tree in memory at once
+        with open(LEGACY_DATA_FILE, "rb") as f:
+            return [{**t, "id": int(t["id"])} for t in ijson.items(f, "item", use_float=True)]
+    return _json_loads(LEGACY_DATA_FILE.read_bytes())
+
+def _load_jsonl_tasks():
+    with open(JSONL_DATA_FILE, "rb") as f:
+        return _replay(_jsonl_records(f))
+
+def load_tasks():
+    if not DATA_FILE.exists() and (JSONL_DATA_FILE.exists() or LEGACY_DATA_FILE.exists()):
+        # One-off migration from tasks.jsonl or the even older tasks.json.
+        # Parse errors propagate: writing an empty log here would hide the
+        # old file for good.
+        with _locked(_writer()["lock"]):
+            if not DATA_FILE.exists():
+                if JSONL_DATA_FILE.exists():
+                    tasks = _load_jsonl_tasks()
+                else:
+                    tasks = _load_legacy_tasks()
+                _write_snapshot(tasks)
+    mtime = DATA_FILE.stat().st_mtime if DATA_FILE.exists() else 0.0
+    return _load_tasks(mtime)
+
+# ---------- Background writer ----------
+SAVE_DEBOUNCE_SECONDS = 0.2
+SAVE_RETRY_SECONDS = 5
+
+def _drain(q) -> list:
+    batch = []
+    while True:
+        try:
+            batch.append(q.get_nowait())
+        except queue.Empty:
+            return batch
+
+def _flush(writer: dict, live_size: float) -> float:
+    # Append everything queued in one write, then compact once the log has
+    # grown past COMPACT_RATIO times the size of the live task set.
+    # Runs on the writer thread and at exit, where st.cache_* has no script
+    # context, so the lock comes in with `writer` rather than from a cache.
+    with _locked(writer["lock"]):
+        pending = writer["pending"]
+        pending.extend(_drain(writer["queue"]))
+        if pending and not writer["repaired"]:
+            _repair_log()
+            writer["repaired"] = True
+        if pending:
+            start = DATA_FILE.stat().st_size if DATA_FILE.exists() else 0
+            with open(DATA_FILE, "ab") as f:
+                try:
+                    f.write(b"".join(pending))
+                    f.flush()
+                except OSError:
+                    # Drop a partial append so the retry doesn't leave a torn
+                    # record in the middle of the log
+                    f.truncate(start)
+                    raise
+            pending.clear()
+            if DATA_FILE.stat().st_size > COMPACT_RATIO * live_size:
+                live_size = _write_snapshot(_read_log())
+    return live_size
+
+def _writer_loop(writer: dict):
+    # live_size starts at 0 so the first flush also compacts whatever bloat
+    # an earlier run left behind
+    live_size = 0
+    wake = writer["wake"]
+    while True:
+        wake.wait()
+        time.sleep(SAVE_DEBOUNCE_SECONDS)
+        wake.clear()
+        try:
+            live_size = _flush(writer, live_size)
+            writer["error"] = None
+        except Exception as e:
+            # Unwritten records stay in writer["pending"]; keep the thread
+            # alive and try again instead of silently dropping every save
+            logger.exception("Saving tasks failed")
+            writer["error"] = e
+            time.sleep(SAVE_RETRY_SECONDS)
+            wake.set()
+
+@st.cache_resource
+def _writer() -> dict:
+    # Streamlit re-executes this module on every rerun, so the queue has to
+    # live in a cached resource to be shared with the single writer thread
+    writer = {
+        "queue": queue.Queue(), "wake": threading.Event(), "lock": threading.Lock(),
+        "pending": [], "error": None, "repaired": False,
+    }
+    threading.Thread(target=_writer_loop, args=(writer,), name="tasks-writer", daemon=True).start()
+    atexit.register(_flush, writer, float("inf"))
+    return writer
+
+def _append_op(op: str, task: dict):
+    # Encoding here snapshots the task, so later in-place edits can't leak in
+    writer = _writer()
+    writer["queue"].put(_record(op, task))
+    writer["wake"].set()
+
+def _save_error():
+    """The exception from the last failed background save, if it hasn't recovered."""
+    return _writer()["error"]
 
 # ---------- Perplexity API helpers ----------
-def perplexity_chat(prompt: str, max_tokens: int = 100, temperature: float = 0.3) -> str:
-    url = "https://api.perplexity.ai/chat/completions"
-    headers = {
+PERPLEXITY_URL = "https://api.perplexity.ai/chat/completions"
+CATEGORIES = ["work","personal","shopping","errands","learning","other"]
+_CAT_RE = re.compile(r"\b(" + "|".join(CATEGORIES) + r")\b", re.I)
+
+def _perplexity_headers() -> dict:
+    return {
         "Authorization": f"Bearer {PERPLEXITY_API_KEY}",
         "Content-Type": "application/json"
     }
-    payload = {
+
+def _perplexity_payload(prompt: str, max_tokens: int, temperature: float) -> dict:
+    return {
         "model": "sonar-pro",
         "messages": [{"role": "user", "content": prompt}],
         "max_tokens": max_tokens,
         "temperature": temperature
     }
+
+AI_CACHE_TTL_SECONDS = 24*60*60
+
+@st.cache_resource
+def _http_pool():
+    # Idle keep-alive sessions shared across reruns and browser sessions
+    return queue.LifoQueue()
+
+@contextmanager
+def _http():
+    """Borrow a keep-alive session so repeat calls skip the TCP+TLS handshake.
+
+    requests.Session isn't guaranteed thread-safe, so each in-flight request
+    gets its own session instead of all of them queueing on one lock.
+    """
+    pool = _http_pool()
+    try:
+        session = pool.get_nowait()
+    except queue.Empty:
+        session = requests.Session()
+        session.headers.update(_perplexity_headers())
     try:
-        resp = requests.post(url, headers=headers, json=payload, timeout=30)
-        resp.raise_for_status()
-        data = resp.json()
-        return data["choices"][0]["message"]["content"].strip()
+        yield session
+    finally:
+        pool.put(session)
+
+@st.cache_resource
+def _token_budget():
+    # (timestamp, tokens) for every request in the last minute, shared by all sessions
+    return deque(), threading.Lock()
+
+def _reserve_tokens(tokens: int):
+    """Block until `tokens` fits under PERPLEXITY_TOKENS_PER_MINUTE, then book it."""
+    window, lock = _token_budget()
+    while True:
+        with lock:
+            now = time.monotonic()
+            while window and now - window[0][0] >= 60:
+                window.popleft()
+            used = sum(n for _, n in window)
+            # An empty window always admits the request, even an oversized one
+            if not window or used + tokens <= PERPLEXITY_TOKENS_PER_MINUTE:
+                window.append((now, tokens))
+                return
+            wait = 60 - (now - window[0][0])
+        time.sleep(wait)
+
+def _estimate_tokens(prompt: str, max_tokens: int) -> int:
+    # ~4 characters per token is close enough for budgeting
+    return len(prompt) // 4 + max_tokens
+
+def _is_transient(exc: BaseException) -> bool:
+    if isinstance(exc, (requests.ConnectionError, requests.Timeout)):
+        return True
+    if isinstance(exc, requests.HTTPError) and exc.response is not None:
+        return exc.response.status_code == 429 or exc.response.status_code >= 500
+    return False
+
+@retry(
+    stop=stop_after_attempt(3),
+    wait=wait_exponential(min=1, max=8),
+    retry=retry_if_exception(_is_transient),
+    reraise=True,
+)
+def _perplexity_request(prompt: str, max_tokens: int, temperature: float) -> str:
+    _reserve_tokens(_estimate_tokens(prompt, max_tokens))
+    payload = _perplexity_payload(prompt, max_tokens, temperature)
+    with _http() as session:
+        resp = session.post(PERPLEXITY_URL, json=payload, timeout=30)
+    resp.raise_for_status()
+    data = resp.json()
+    return data["choices"][0]["message"]["content"].strip()
+
+@st.cache_data(ttl=AI_CACHE_TTL_SECONDS, show_spinner=False, max_entries=1024)
+def _perplexity_chat_cached(prompt: str, max_tokens: int, temperature: float) -> str:
+    # Failures raise, and st.cache_data never caches exceptions, so only
+    # real answers are memoized
+    return _perplexity_request(prompt, max_tokens, temperature)
+
+def perplexity_chat(prompt: str, max_tokens: int = 100, temperature: float = 0.3, use_cache: bool = True) -> str:
+    try:
+        if use_cache:
+            return _perplexity_chat_cached(prompt, max_tokens, temperature)
+        return _perplexity_request(prompt, max_tokens, temperature)
     except Exception as e:
         st.error(f"AI request failed: {e}")
         return ""
 
-def ai_suggest_title(description: str) -> str:
-    if not USE_PERPLEXITY:
-        return ""
-    prompt = f"You are a helpful assistant that suggests short, clear, actionable todo titles.\nTask description: {description}\nReturn a 3-6 word title."
-    return perplexity_chat(prompt, max_tokens=30, temperature=0.3)
+def _analyze_prompt(title: str, description: str) -> str:
+    return (
+        "You are a helpful assistant that titles and categorizes todo items.\n"
+        f"Title: {title}\nDescription: {description}\n"
+        'Return only a JSON object with keys "title" (a short, clear, actionable 3-6 word title) '
+        'and "category" (one of: work, personal, shopping, errands, learning, other).'
+    )
+
+def _parse_category(text: str) -> str:
+    m = _CAT_RE.search(text)
+    return m.group(1).lower() if m else "other"
 
-def ai_categorize(title: str, description: str) -> str:
+def ai_analyze(title: str, description: str) -> dict:
+    """Suggest a title and a category for a todo with a single AI request."""
     if not USE_PERPLEXITY:
-        return ""
-    prompt = f"You are an assistant that assigns a concise category to a todo item (work, personal, shopping, errands, learning, other).\nTitle: {title}\nDescription: {description}\nOnly return one of the categories: work, personal, shopping, errands, learning, other."
-    cat = perplexity_chat(prompt, max_tokens=10, temperature=0.0).lower()
-    for c in ["work","personal","shopping","errands","learning","other"]:
-        if c in cat:
-            return c
-    return "other"
+        return {"title": "", "category": ""}
+    text = perplexity_chat(_analyze_prompt(title, description), max_tokens=60, temperature=0.0)
+    try:
+        # Models sometimes wrap the object in prose or a code fence
+        data = _json_loads(text[text.index("{"):text.rindex("}") + 1].encode("utf-8"))
+        category = str(data.get("category", "")).lower()
+        return {
+            "title": str(data.get("title", "")).strip(),
+            "category": category if category in CATEGORIES else _parse_category(category),
+        }
+    except (ValueError, AttributeError):
+        return {"title": "", "category": _parse_category(text)}
+
+# ---------- Task index helpers ----------
+def _set_tasks(tasks):
+    # Tasks are indexed by id; `order` keeps their list position
+    st.session_state.tasks_by_id = {t["id"]: t for t in tasks}
+    st.session_state.order = [t["id"] for t in tasks]
+    # (session_token, tasks_version) fingerprints this session's tasks for _view
+    st.session_state.session_token = uuid.uuid4().hex
+    st.session_state.tasks_version = 0
+    _build_sort_index()
+
+@st.cache_resource
+def _id_allocator():
+    # One counter per server: a per-session counter would hand the same id to
+    # two tabs, and the second upsert would overwrite the first on replay
+    seed = max((t["id"] for t in load_tasks()), default=0) + 1
+    return itertools.count(seed), threading.Lock()
+
+def _next_id() -> int:
+    counter, lock = _id_allocator()
+    with lock:
+        return next(counter)
+
+def _touch():
+    st.session_state.tasks_version += 1
+
+def _mark_dirty(task_id):
+    st.session_state.dirty_ids[task_id] = None
+    _touch()
+
+def _flush_dirty():
+    """Append one upsert per task changed since the last flush."""
+    tasks_by_id = st.session_state.tasks_by_id
+    for task_id in st.session_state.dirty_ids:
+        if task_id in tasks_by_id:
+            _append_op("upsert", tasks_by_id[task_id])
+    st.session_state.dirty_ids.clear()
+
+def _rerun(scope: str = "app"):
+    # st.rerun() stops the script here, before the end-of-run flush
+    _flush_dirty()
+    st.rerun(scope=scope)
+
+# ---------- View helpers ----------
+PRIORITY_RANK = {"High":0, "Medium":1, "Low":2}
+SORT_KEYS = {
+    "created": lambda t: t.get("created_at") or "",
+    "due": lambda t: t.get("due") or "9999-99-99",
+    "priority": lambda t: PRIORITY_RANK.get(t.get("priority","Medium"), 1),
+}
+
+def _build_sort_index():
+    # Ascending id lists per sort option, kept current by _index_add/_index_remove
+    tasks_by_id = st.session_state.tasks_by_id
+    st.session_state.sort_index = {
+        name: sorted(st.session_state.order, key=lambda i, k=key: k(tasks_by_id[i]))
+        for name, key in SORT_KEYS.items()
+    }
+
+def _index_add(task_id):
+    tasks_by_id = st.session_state.tasks_by_id
+    for name, key in SORT_KEYS.items():
+        bisect.insort(st.session_state.sort_index[name], task_id, key=lambda i, k=key: k(tasks_by_id[i]))
+    _touch()
+
+def _index_remove(task_id):
+    for ids in st.session_state.sort_index.values():
+        ids.remove(task_id)
+    _touch()
+
+def _index_move_to_front(task_id):
+    # First among equal sort keys, matching what _build_sort_index derives
+    # from `order` on the next load
+    tasks_by_id = st.session_state.tasks_by_id
+    for name, key in SORT_KEYS.items():
+        ids = st.session_state.sort_index[name]
+        ids.remove(task_id)
+        pos = bisect.bisect_left(ids, key(tasks_by_id[task_id]), key=lambda i, k=key: k(tasks_by_id[i]))
+        ids.insert(pos, task_id)
+    _touch()
+
+def _view(show_done: bool, filter_cat: str, sort_by: str) -> list:
+    """Ids of the tasks to display, filtered and in display order."""
+    fingerprint = (st.session_state.session_token, st.session_state.tasks_version)
+    return _cached_view(show_done, filter_cat, sort_by, fingerprint, st.session_state.tasks_by_id, st.session_state.sort_index)
+
+@st.cache_data(show_spinner=False, max_entries=256)
+def _cached_view(show_done: bool, filter_cat: str, sort_by: str, fingerprint: tuple, _tasks_by_id: dict, _sort_index: dict) -> list:
+    # Only the filters and the fingerprint are hashed (st.cache_data skips
+    # underscore arguments), so reruns that change no task skip the scan
+    tasks_by_id = _tasks_by_id
+    ids = _sort_index[sort_by]
+    if sort_by == "created":
+        ids = reversed(ids)  # newest first
+    return [
+        i for i in ids
+        if (show_done or not tasks_by_id[i].get("done"))
+        and (filter_cat == "all" or tasks_by_id[i].get("category","uncategorized") == filter_cat)
+    ]
+
+def _task_html(t: dict) -> str:
+    meta = f"[{t.get('category','uncategorized')}] • {t.get('priority','Medium')}"
+    if t.get("due"):
+        meta += f" • due {t.get('due')}"
+    mark = "☑" if t.get("done") else "☐"
+    summary = f"{mark} <strong>{html.escape(t.get('title') or '')}</strong> <small>{html.escape(meta)}</small>"
+    # No raw newline may reach the markdown: a blank line would end the HTML
+    # block and could turn every later task into a code block
+    description = html.escape(t.get('description') or '').replace("\r\n", "\n").replace("\r", "\n").replace("\n", "<br>")
+    body = f"<div style='white-space: pre-wrap'>{description}</div>"
+    return f"<details><summary>{summary}</summary>{body}</details>"
 
 # ---------- App UI ----------
 st.set_page_config(page_title="AI To-Do List", layout="centered")
 st.title("🗒️ Smart To-Do List")
 
-# Load tasks from file on start
-if not st.session_state.tasks:
-    st.session_state.tasks = load_tasks()
+# Load tasks once per session; an empty list is a valid loaded state
+if "tasks_by_id" not in st.session_state:
+    _set_tasks(load_tasks())
 
 # ---------- Add Task Form ----------
-with st.form("add_task_form", clear_on_submit=False):
-    st.subheader("Add a task")
-    col1, col2 = st.columns([3,1])
-    with col1:
-        title_input = st.text_input(
-            "Title",
-            value=st.session_state.get("ai_suggested_title", ""),
-            key="title_input"
-        )
-        desc_input = st.text_area("Description", height=80, key="desc_input")
-    with col2:
-        due = st.date_input("Due date", value=None)
-        priority = st.selectbox("Priority", ["Medium","High","Low"]) 
-        category = st.selectbox("Category", ["uncategorized","work","personal","shopping","errands","learning","other"]) 
-    submitted = st.form_submit_button("Add task")
-
-if submitted:
-    if not title_input.strip() and not desc_input.strip():
-        st.error("Please provide at least a title or description.")
-    else:
-        task = {
-            "id": int(datetime.now(timezone.utc).timestamp()*1000),
-            "title": title_input.strip() or (desc_input.strip()[:60] + "..."),
-            "description": desc_input.strip(),
-            "created_at": datetime.now(timezone.utc).isoformat(),
-            "due": str(due) if due else "",
-            "priority": priority,
-            "category": category,
-            "done": False,
-        }
-        st.session_state.tasks.append(task)
-        save_tasks(st.session_state.tasks)
-        st.success("Task added!")
-        # Reset AI suggestion after adding
-        st.session_state.ai_suggested_title = ""
-        st.session_state.refresh = not st.session_state.refresh
-
-# ---------- AI Buttons (outside form) ----------
-if USE_PERPLEXITY:
-    col1, col2 = st.columns(2)
-    with col1:
-        if st.button("Suggest title from description"):
-            if desc_input.strip():
-                suggested = ai_suggest_title(desc_input.strip())
-                if suggested:
-                    st.session_state.ai_suggested_title = suggested
-                    st.info(f"AI suggested title: **{suggested}**")
-                else:
-                    st.info("Couldn't get suggestion.")
-    with col2:
-        if st.button("Auto-categorize"):
-            if title_input.strip() or desc_input.strip():
-                cat = ai_categorize(title_input.strip(), desc_input.strip())
-                if cat:
-                    st.info(f"AI suggests category: {cat}")
+# Each region is a fragment, so interacting with one only reruns that region
+@st.fragment
+def _add_form():
+    # Widget values can only be set before the widget exists in a run
+    st.session_state.update(st.session_state.ai_suggested)
+    st.session_state.ai_suggested = {}
+
+    with st.form("add_task_form", clear_on_submit=False):
+        st.subheader("Add a task")
+        col1, col2 = st.columns([3,1])
+        with col1:
+            title_input = st.text_input("Title", key="title_input")
+            desc_input = st.text_area("Description", height=80, key="desc_input")
+        with col2:
+            due = st.date_input("Due date", value=None)
+            priority = st.selectbox("Priority", ["Medium","High","Low"]) 
+            category = st.selectbox("Category", ["uncategorized","work","personal","shopping","errands","learning","other"])
+        submitted = st.form_submit_button("Add task")
+
+    if submitted:
+        if not title_input.strip() and not desc_input.strip():
+            st.error("Please provide at least a title or description.")
+        else:
+            task = {
+                "id": _next_id(),
+                "title": title_input.strip() or (desc_input.strip()[:60] + "..."),
+                "description": desc_input.strip(),
+                "created_at": datetime.now(timezone.utc).isoformat(),
+                "due": str(due) if due else "",
+                "priority": priority,
+                "category": category,
+                "done": False,
+            }
+            st.session_state.tasks_by_id[task["id"]] = task
+            st.session_state.order.append(task["id"])
+            _index_add(task["id"])
+            _mark_dirty(task["id"])
+            # The task list lives in the other fragment
+            _rerun(scope="app")
+
+    # ---------- AI Buttons (outside form) ----------
+    if USE_PERPLEXITY:
+        # Both buttons share one cached request per (title, description)
+        col1, col2 = st.columns(2)
+        with col1:
+            if st.button("Suggest title from description"):
+                if desc_input.strip():
+                    suggested = ai_analyze(title_input.strip(), desc_input.strip())["title"]
+                    if suggested:
+                        st.session_state.ai_suggested = {"title_input": suggested}
+                        _rerun(scope="fragment")
+                    else:
+                        st.info("Couldn't get suggestion.")
+        with col2:
+            if st.button("Auto-categorize"):
+                if title_input.strip() or desc_input.strip():
+                    cat = ai_analyze(title_input.strip(), desc_input.strip())["category"]
+                    if cat:
+                        st.info(f"AI suggests category: {cat}")
+
+    _flush_dirty()
 
 # ---------- Filters and Display ----------
-st.markdown("---")
-filter_col1, filter_col2, filter_col3 = st.columns([2,2,2])
-with filter_col1:
-    show_done = st.checkbox("Show done", value=True)
-with filter_col2:
-    filter_cat = st.selectbox("Filter by category", ["all","uncategorized","work","personal","shopping","errands","learning","other"]) 
-with filter_col3:
-    sort_by = st.selectbox("Sort by", ["created","due","priority"])
-
-filtered = []
-for t in st.session_state.tasks:
-    if not show_done and t.get("done"):
-        continue
-    if filter_cat != "all" and t.get("category","uncategorized") != filter_cat:
-        continue
-    filtered.append(t)
-
-# Sorting
-if sort_by == "due":
-    filtered.sort(key=lambda x: x.get("due") or "9999-99-99")
-elif sort_by == "priority":
-    order = {"High":0, "Medium":1, "Low":2}
-    filtered.sort(key=lambda x: order.get(x.get("priority","Medium"), 1))
-else:
-    filtered.sort(key=lambda x: x.get("created_at"), reverse=True)
-
-st.subheader(f"Tasks ({len(filtered)})")
-if not filtered:
-    st.info("No tasks found.")
-
-# ---------- Task display and actions ----------
-for t in filtered:
-    cols = st.columns([0.06, 0.94])
-    with cols[0]:
-        done = st.checkbox("Task done", value=t.get("done", False), key=f"done_{t['id']}", label_visibility="collapsed")
-    with cols[1]:
-        title_display = t.get("title")
-        meta = f"[{t.get('category','uncategorized')}] • {t.get('priority','Medium')}"
-        if t.get("due"):
-            meta += f" • due {t.get('due')}"
-        st.markdown(f"**{title_display}**\n{meta}")
-        if t.get("description"):
-            st.write(t.get("description"))
+@st.fragment
+def _task_list():
+    save_error = _save_error()
+    if save_error is not None:
+        st.error(f"Saving tasks failed, retrying in the background: {save_error}")
+    st.markdown("---")
+    filter_col1, filter_col2, filter_col3 = st.columns([2,2,2])
+    with filter_col1:
+        show_done = st.checkbox("Show done", value=True)
+    with filter_col2:
+        filter_cat = st.selectbox("Filter by category", ["all","uncategorized","work","personal","shopping","errands","learning","other"]) 
+    with filter_col3:
+        sort_by = st.selectbox("Sort by", ["created","due","priority"])
+
+    tasks_by_id = st.session_state.tasks_by_id
+    view_ids = _view(show_done, filter_cat, sort_by)
+    filtered = [tasks_by_id[i] for i in view_ids]
+
+    # Filled in below, once this run's actions have been applied
+    task_list = st.container()
+
+    # ---------- Task actions (only built on demand) ----------
+    if filtered and st.toggle("Manage tasks"):
+        # One data_editor frame carries every done checkbox
+        edited = st.data_editor(
+            [
+                {"id": t["id"], "done": bool(t.get("done")), "title": t.get("title"),
+                 "category": t.get("category","uncategorized"), "priority": t.get("priority","Medium"), "due": t.get("due")}
+                for t in filtered
+            ],
+            column_order=("done","title","category","priority","due"),
+            disabled=("title","category","priority","due"),
+            hide_index=True,
+            use_container_width=True,
+            # data_editor keeps edits by row position; keying on the rows it shows
+            # drops stale edits once the rows move or a toggle has been applied
+            key=f"done_editor_{hash(tuple((t['id'], bool(t.get('done'))) for t in filtered))}",
+        )
+        toggled = False
+        for row in edited:
+            t = tasks_by_id[row["id"]]
+            if bool(row["done"]) != bool(t.get("done")):
+                t['done'] = bool(row["done"])
+                _mark_dirty(t['id'])
+                toggled = True
+        if toggled:
+            # The editor's key depends on the done flags, so redraw it now;
+            # otherwise the next click is sent to the stale key and lost
+            _rerun(scope="fragment")
+
+        selected_id = st.selectbox("Task", view_ids, format_func=lambda i: tasks_by_id[i].get("title"), key="action_task")
+        t = tasks_by_id[selected_id]
         a1, a2, a3 = st.columns([1,1,1])
-        if a1.button("Edit", key=f"edit_{t['id']}"):
+        if a1.button("Edit"):
             st.session_state.edit_id = t['id']
             st.session_state.edit_title = t.get('title')
             st.session_state.edit_description = t.get('description')
             st.session_state.edit_due = t.get('due')
             st.session_state.edit_priority = t.get('priority')
             st.session_state.edit_category = t.get('category')
-            st.session_state.refresh = not st.session_state.refresh
-        if a2.button("Delete", key=f"del_{t['id']}"):
-            st.session_state.tasks = [x for x in st.session_state.tasks if x['id'] != t['id']]
-            save_tasks(st.session_state.tasks)
-            st.success("Deleted")
-            st.session_state.refresh = not st.session_state.refresh
-        if a3.button("Move to top", key=f"top_{t['id']}"):
-            st.session_state.tasks = [x for x in st.session_state.tasks if x['id'] != t['id']]
-            st.session_state.tasks.insert(0, t)
-            save_tasks(st.session_state.tasks)
-            st.session_state.refresh = not st.session_state.refresh
-    if done != t.get("done", False):
-        for task in st.session_state.tasks:
-            if task['id'] == t['id']:
-                task['done'] = done
-        save_tasks(st.session_state.tasks)
-        st.session_state.refresh = not st.session_state.refresh
-
-# ---------- Edit task form ----------
-if st.session_state.get('edit_id'):
-    st.markdown("---")
-    st.subheader("Edit task")
-    eid = st.session_state.edit_id
-    etitle = st.text_input("Title", value=st.session_state.get('edit_title',''), key='etitle')
-    edesc = st.text_area("Description", value=st.session_state.get('edit_description',''), key='edesc')
-    edue = st.text_input("Due (YYYY-MM-DD)", value=st.session_state.get('edit_due',''), key='edue')
-    epriority = st.selectbox("Priority", ["Medium","High","Low"], index=["Medium","High","Low"].index(st.session_state.get('edit_priority','Medium')))
-    ecat = st.selectbox("Category", ["uncategorized","work","personal","shopping","errands","learning","other"], index=["uncategorized","work","personal","shopping","errands","learning","other"].index(st.session_state.get('edit_category','uncategorized')))
+        if a2.button("Delete"):
+            st.session_state.order.remove(t['id'])
+            _index_remove(t['id'])
+            del tasks_by_id[t['id']]
+            _append_op("del", {"id": t['id']})
+            # The editor and task picker above still list the deleted task
+            _rerun(scope="fragment")
+        if a3.button("Move to top"):
+            st.session_state.order.remove(t['id'])
+            st.session_state.order.insert(0, t['id'])
+            _index_move_to_front(t['id'])
+            _append_op("top", {"id": t['id']})
+            # Under due/priority sort this reorders equal-key tasks, and the
+            # picker and editor above were keyed on the old order
+            _rerun(scope="fragment")
+
+        view_ids = _view(show_done, filter_cat, sort_by)
+        filtered = [tasks_by_id[i] for i in view_ids]
+
+        st.download_button(
+            "Export JSON",
+            _json_dumps([tasks_by_id[i] for i in st.session_state.order]),
+            file_name="tasks.json",
+            mime="application/json",
+        )
+
+    # ---------- Task display ----------
+    with task_list:
+        st.subheader(f"Tasks ({len(filtered)})")
+        if not filtered:
+            st.info("No tasks found.")
+        else:
+            # A single markdown element instead of a widget tree per task
+            st.markdown("".join(_task_html(t) for t in filtered), unsafe_allow_html=True)
+
+    # ---------- Edit task form ----------
+    if st.session_state.get('edit_id'):
+        st.markdown("---")
+        st.subheader("Edit task")
+        eid = st.session_state.edit_id
+        etitle = st.text_input("Title", value=st.session_state.get('edit_title',''), key='etitle')
+        edesc = st.text_area("Description", value=st.session_state.get('edit_description',''), key='edesc')
+        edue = st.text_input("Due (YYYY-MM-DD)", value=st.session_state.get('edit_due',''), key='edue')
+        epriority = st.selectbox("Priority", ["Medium","High","Low"], index=["Medium","High","Low"].index(st.session_state.get('edit_priority','Medium')))
+        ecat = st.selectbox("Category", ["uncategorized","work","personal","shopping","errands","learning","other"], index=["uncategorized","work","personal","shopping","errands","learning","other"].index(st.session_state.get('edit_category','uncategorized')))
     
-    if st.button("Save changes"):
-        for task in st.session_state.tasks:
-            if task['id'] == eid:
+        if st.button("Save changes"):
+            task = st.session_state.tasks_by_id.get(eid)
+            if task is not None:
+                _index_remove(eid)
                 task['title'] = etitle.strip()
                 task['description'] = edesc.strip()
                 task['due'] = edue.strip()
                 task['priority'] = epriority
                 task['category'] = ecat
-        save_tasks(st.session_state.tasks)
-        st.success("Saved")
-        for k in ['edit_id','edit_title','edit_description','edit_due','edit_priority','edit_category']:
-            st.session_state.pop(k, None)
-        st.session_state.refresh = not st.session_state.refresh
+                _index_add(eid)
+                _mark_dirty(eid)
+            for k in ['edit_id','edit_title','edit_description','edit_due','edit_priority','edit_category']:
+                st.session_state.pop(k, None)
+            # The task list above was drawn before the edit and the form should close
+            _rerun(scope="fragment")
+
+    _flush_dirty()
+
+_add_form()
+_task_list()